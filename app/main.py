@@ -1,8 +1,18 @@
 from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel, ConfigDict
 from typing import Dict, Optional, Any
+import orjson
 
-app = FastAPI(title="Sharding API", version="1.0")
+
+class FastJSONResponse(JSONResponse):
+    """JSON-відповідь, серіалізована orjson (ORJSONResponse у FastAPI застарів)"""
+
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY)
+
+
+app = FastAPI(title="Sharding API", version="1.0", default_response_class=FastJSONResponse)
 
 # Зберігаємо таблиці в пам’яті
 TABLES: Dict[str, Dict[str, Any]] = {}
@@ -10,6 +20,8 @@ TABLES: Dict[str, Dict[str, Any]] = {}
 
 # ----- 1a. Реєстрація таблиці -----
 class TableDefinition(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+
     name: str
     primary_key: str
     sort_key: Optional[str] = None  # опціонально
@@ -25,6 +37,8 @@ def register_table(definition: TableDefinition):
 
 # ----- 1b. CRUD -----
 class Record(BaseModel):
+    model_config = ConfigDict(extra="ignore", str_max_length=1024, strict=False)
+
     key: str
     sort_key: Optional[str] = None
     value: dict
@@ -1,31 +1,56 @@
-import hashlib
 import bisect
+import numpy as np
+import xxhash
 
 class ConsistentHashRing:
-    def __init__(self, replicas=3):
+    def __init__(self, replicas=160):
         self.replicas = replicas
-        self.ring = {}
+        self.nodes = []
+        # Відсортовані хеші віртуальних вузлів і індекс вузла-власника для кожного
+        self.hashes = np.empty(0, dtype=np.uint64)
+        self.owners = np.empty(0, dtype=np.intp)
+        # Ті самі дані як list: для одного ключа bisect швидший за виклик numpy
         self.sorted_keys = []
+        self.sorted_nodes = []
 
     def _hash(self, key: str):
-        return int(hashlib.md5(key.encode()).hexdigest(), 16)
+        return xxhash.xxh3_64_intdigest(key.encode())
+
+    def _rebuild(self):
+        count = len(self.nodes) * self.replicas
+        hashes = np.fromiter(
+            (self._hash(f"{node}:{i}") for node in self.nodes for i in range(self.replicas)),
+            dtype=np.uint64,
+            count=count,
+        )
+        owners = np.repeat(np.arange(len(self.nodes), dtype=np.intp), self.replicas)
+        order = np.argsort(hashes, kind="stable")
+        self.hashes = hashes[order]
+        self.owners = owners[order]
+        self.sorted_keys = self.hashes.tolist()
+        self.sorted_nodes = [self.nodes[i] for i in self.owners.tolist()]
 
     def add_node(self, node):
-        for i in range(self.replicas):
-            key = self._hash(f"{node}:{i}")
-            self.ring[key] = node
-            bisect.insort(self.sorted_keys, key)
+        if node not in self.nodes:
+            self.nodes.append(node)
+            self._rebuild()
 
     def remove_node(self, node):
-        for i in range(self.replicas):
-            key = self._hash(f"{node}:{i}")
-            if key in self.ring:
-                del self.ring[key]
-                self.sorted_keys.remove(key)
+        if node in self.nodes:
+            self.nodes.remove(node)
+            self._rebuild()
 
     def get_node(self, key):
-        if not self.ring:
+        if not self.sorted_keys:
             return None
         hash_val = self._hash(key)
-        idx = bisect.bisect(self.sorted_keys, hash_val) % len(self.sorted_keys)
-        return self.ring[self.sorted_keys[idx]]
+        idx = bisect.bisect_right(self.sorted_keys, hash_val) % len(self.sorted_keys)
+        return self.sorted_nodes[idx]
+
+    def get_nodes(self, keys):
+        """Вузли для пачки ключів: один виклик np.searchsorted на всю пачку"""
+        if not self.sorted_keys:
+            return [None] * len(keys)
+        hashes = np.fromiter((self._hash(key) for key in keys), dtype=np.uint64, count=len(keys))
+        idx = np.searchsorted(self.hashes, hashes, side="right") % len(self.hashes)
+        return [self.nodes[i] for i in self.owners[idx].tolist()]
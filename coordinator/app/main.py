@@ -1,32 +1,98 @@
 #TEST Deploy
-from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
-from typing import Dict, Any, Optional
+import asyncio
+import functools
+import heapq
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel, ConfigDict
+from typing import Dict, Any, List, Optional, Set, Tuple
+from urllib.parse import quote
+import os
 import httpx
+import msgspec
+import orjson
 from consistent_hash import ConsistentHashRing
 
-app = FastAPI(title="Coordinator with Sharding and Compound Keys")
+SHARD_HTTP2 = os.getenv("SHARD_HTTP2", "1") == "1"
+
+
+class FastJSONResponse(JSONResponse):
+    """JSON-відповідь, серіалізована orjson (ORJSONResponse у FastAPI застарів)"""
+
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Один спільний HTTP-клієнт з пулом keep-alive з'єднань до shards"""
+    # SHARD_HTTP2=1: shards обслуговує hypercorn, тож говоримо з ними h2c (prior knowledge)
+    # і мультиплексуємо багато запитів в одному TCP-з'єднанні.
+    # keepalive_expiry має бути меншим за --keep-alive hypercorn (75 с у Dockerfile shard),
+    # інакше пул віддає з'єднання, яке сервер уже закрив
+    app.state.http = httpx.AsyncClient(
+        http1=not SHARD_HTTP2,
+        http2=SHARD_HTTP2,
+        limits=httpx.Limits(max_keepalive_connections=20, max_connections=100, keepalive_expiry=30.0),
+        timeout=httpx.Timeout(5.0),
+    )
+    try:
+        yield
+    finally:
+        await app.state.http.aclose()
+
+
+app = FastAPI(
+    title="Coordinator with Sharding and Compound Keys",
+    lifespan=lifespan,
+    default_response_class=FastJSONResponse,
+)
 
 # --- Дані ---
 SHARDS: Dict[str, str] = {}  # name -> URL
-RING = ConsistentHashRing()
+RING = ConsistentHashRing(replicas=int(os.getenv("COORDINATOR_REPLICAS", "160")))
 TABLES: Dict[str, Dict[str, Any]] = {}  # таблиці
+JSON_HEADERS = {"content-type": "application/json"}
+# Запити READ, що зараз виконуються: (table, composite_key) -> спільна задача
+INFLIGHT: Dict[Tuple[str, str], asyncio.Task] = {}
+MAX_INFLIGHT = 10000
+BACKGROUND_TASKS: Set[asyncio.Task] = set()
+RETRY_METHODS = frozenset({"GET", "HEAD"})  # повторний запит не змінює стан shard
 
 # --- Моделі ---
 class ShardRegistration(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+
     name: str
     url: str
 
 class TableDef(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+
     name: str
     partition_key_name: str
     sort_key_name: Optional[str] = None
 
-class KeyValue(BaseModel):
+# Дані, що йдуть на shards, розбираються msgspec: C-валідація без накладних витрат Pydantic
+class KeyValue(msgspec.Struct, omit_defaults=True):
     table: str
     key: str
     sort_key: Optional[str] = None
     value: Optional[dict] = None
+    composite_key: Optional[str] = None  # заповнює координатор для batch-запитів
+
+
+class RoutingFields(msgspec.Struct):
+    """Лише поля для маршрутизації; решта тіла не валідується"""
+    table: str
+    key: str
+    sort_key: Optional[str] = None
+
+
+ROUTING_DECODER = msgspec.json.Decoder(RoutingFields)
+BATCH_DECODER = msgspec.json.Decoder(List[KeyValue])
 
 
 # --- API ---
@@ -35,7 +101,7 @@ def register_table(defn: TableDef):
     """Реєстрація схеми таблиці"""
     if defn.name in TABLES:
         raise HTTPException(status_code=400, detail="Table already exists")
-    TABLES[defn.name] = defn.dict()
+    TABLES[defn.name] = defn.model_dump()
     return {"message": "Table registered", "table": defn.name}
 
 
@@ -45,13 +111,37 @@ def list_tables():
     return {"tables": list(TABLES.keys())}
 
 
+async def shard_request(method: str, url: str, **kwargs) -> httpx.Response:
+    """Запит до shard через спільний пул; читання повторюється один раз, якщо з'єднання розірвано"""
+    try:
+        return await app.state.http.request(method, url, **kwargs)
+    except (httpx.RemoteProtocolError, httpx.WriteError) as exc:
+        # Розрив не означає, що shard не отримав запит: він міг закрити з'єднання вже після
+        # обробки. Тож повторюємо лише читання; для запису результат невідомий — 502
+        if method not in RETRY_METHODS:
+            raise HTTPException(status_code=502, detail=f"Shard connection lost, write outcome unknown: {exc}")
+        return await app.state.http.request(method, url, **kwargs)
+
+
+async def warm_connection(url: str):
+    """Відкриває з'єднання з shard заздалегідь, щоб перший CRUD не чекав на handshake"""
+    try:
+        await shard_request("GET", f"{url}/health")
+    except httpx.HTTPError:
+        pass  # shard ще не слухає порт — з'єднання відкриється на першому запиті
+
+
 @app.post("/register_shard")
-def register_shard(data: ShardRegistration):
+async def register_shard(data: ShardRegistration):
     """Реєстрація нового shard"""
     if data.name in SHARDS:
         raise HTTPException(status_code=400, detail="Shard already exists")
     SHARDS[data.name] = data.url
     RING.add_node(data.name)
+    cached_shard.cache_clear()  # склад кільця змінився
+    task = asyncio.create_task(warm_connection(data.url))
+    BACKGROUND_TASKS.add(task)  # тримаємо посилання, поки задача не завершиться
+    task.add_done_callback(BACKGROUND_TASKS.discard)
     return {"message": f"Shard {data.name} registered", "url": data.url}
 
 
@@ -61,73 +151,230 @@ def list_shards():
     return {"shards": SHARDS}
 
 
+def make_composite_key(key: str, sort_key: Optional[str]) -> str:
+    """Складений ключ: partition key або partition key:sort key"""
+    return ":".join((key, sort_key)) if sort_key else key
+
+
+@functools.lru_cache(maxsize=65536)
+def cached_shard(key: str) -> Tuple[str, str]:
+    """Кеш результату пошуку в кільці; скидається при зміні складу shards"""
+    shard_name = RING.get_node(key)
+    return shard_name, SHARDS[shard_name]
+
+
 def get_shard_for_key(key: str):
     """Знаходимо shard для конкретного ключа"""
-    shard_name = RING.get_node(key)
-    if shard_name is None:
+    if not SHARDS:
         raise HTTPException(status_code=500, detail="No shards available")
-    return shard_name, SHARDS[shard_name]
+    return cached_shard(key)
+
+
+def shards_for_keys(keys: List[str]) -> List[str]:
+    """Shards для пачки ключів одним векторним пошуком у кільці"""
+    if not SHARDS:
+        raise HTTPException(status_code=500, detail="No shards available")
+    return RING.get_nodes(keys)
+
+
+def envelope(shard_name: str, resp: httpx.Response) -> bytes:
+    """Вкладає тіло відповіді shard у {"target_shard", "response"} без розбору JSON"""
+    return b'{"target_shard":' + orjson.dumps(shard_name) + b',"response":' + resp.content + b"}"
+
+
+def decode_body(decoder: msgspec.json.Decoder, raw: bytes):
+    """Декодує тіло запиту; помилки формату — 422, як у FastAPI"""
+    try:
+        return decoder.decode(raw)
+    except msgspec.DecodeError as exc:
+        raise HTTPException(status_code=422, detail=str(exc))
+
+
+def routing_key(raw: bytes) -> Tuple[str, str]:
+    """Дістає з сирого тіла лише поля для маршрутизації: таблицю і складений ключ"""
+    meta = decode_body(ROUTING_DECODER, raw)
+    return meta.table, make_composite_key(meta.key, meta.sort_key)
+
+
+def key_header(composite_key: str) -> Dict[str, str]:
+    """Складений ключ для shard: формат ключа визначає лише координатор"""
+    # quote: значення заголовків мають бути ASCII, а ключі можуть бути будь-якими
+    return {"x-composite-key": quote(composite_key, safe="")}
+
+
+def forward_headers(composite_key: str) -> Dict[str, str]:
+    """Заголовки для shard: тіло передається як є, складений ключ — у x-composite-key"""
+    return {**JSON_HEADERS, **key_header(composite_key)}
 
 
 # --- CRUD маршрутизація ---
 @app.post("/create")
-async def create_record(data: KeyValue):
+async def create_record(request: Request):
     """CREATE з маршрутизацією по shard (підтримує compound key)"""
-    composite_key = f"{data.key}:{data.sort_key}" if data.sort_key else data.key
+    raw = await request.body()
+    table, composite_key = routing_key(raw)
     shard_name, shard_url = get_shard_for_key(composite_key)
-    payload = data.dict()
-    payload["composite_key"] = composite_key
-    async with httpx.AsyncClient() as client:
-        resp = await client.post(f"{shard_url}/create", json=payload)
-    return {"target_shard": shard_name, "response": resp.json()}
+    # Тіло не перекодовується: shard отримує ті самі байти і сам валідує решту полів
+    resp = await shard_request("POST", f"{shard_url}/create", content=raw, headers=forward_headers(composite_key))
+    if resp.status_code != 200:
+        raise HTTPException(status_code=resp.status_code, detail=resp.text)
+    forget_flight(table, composite_key)
+    return Response(content=envelope(shard_name, resp), media_type="application/json")
 
 
 @app.get("/read/{table}/{key}")
 async def read_record(table: str, key: str, sort_key: Optional[str] = None):
-    """READ — читає з shard"""
-    composite_key = f"{key}:{sort_key}" if sort_key else key
+    """READ — читає з shard; одночасні читання того самого ключа об'єднуються в один запит"""
+    composite_key = make_composite_key(key, sort_key)
     shard_name, shard_url = get_shard_for_key(composite_key)
-    async with httpx.AsyncClient() as client:
-        resp = await client.get(f"{shard_url}/read/{table}/{key}", params={"sort_key": sort_key})
+    flight_key = (table, composite_key)
+    task = INFLIGHT.get(flight_key)
+    if task is None:
+        if len(INFLIGHT) >= MAX_INFLIGHT:
+            body = await fetch_record(shard_name, shard_url, table, key, sort_key, composite_key)
+            return Response(content=body, media_type="application/json")
+        task = asyncio.create_task(fetch_record(shard_name, shard_url, table, key, sort_key, composite_key))
+        INFLIGHT[flight_key] = task
+        task.add_done_callback(lambda done: finish_flight(flight_key, done))
+    # shield: скасування одного клієнта не скасовує запит для решти
+    body = await asyncio.shield(task)
+    return Response(content=body, media_type="application/json")
+
+
+async def fetch_record(
+    shard_name: str, shard_url: str, table: str, key: str, sort_key: Optional[str], composite_key: str
+):
+    """Один запит READ до shard; результат — готове тіло відповіді"""
+    resp = await shard_request(
+        "GET", f"{shard_url}/read/{table}/{key}", params={"sort_key": sort_key}, headers=key_header(composite_key)
+    )
     if resp.status_code != 200:
         raise HTTPException(status_code=resp.status_code, detail=resp.text)
-    return {"target_shard": shard_name, "response": resp.json()}
+    return envelope(shard_name, resp)
+
+
+def finish_flight(flight_key: Tuple[str, str], task: asyncio.Task):
+    """Прибирає завершений запит; помилку позначаємо як отриману, навіть якщо всі клієнти пішли"""
+    if INFLIGHT.get(flight_key) is task:  # після запису ключ міг уже отримати новий запит
+        del INFLIGHT[flight_key]
+    if not task.cancelled():
+        task.exception()
 
 
-@app.get("/exists/{table}/{key}")
+def forget_flight(table: str, composite_key: str):
+    """Після підтвердженого запису читання не приєднуються до запиту, що почався до нього"""
+    INFLIGHT.pop((table, composite_key), None)
+
+
+@app.api_route("/exists/{table}/{key}", methods=["GET", "HEAD"])
 async def exists_record(table: str, key: str, sort_key: Optional[str] = None):
-    """EXISTS — перевірка наявності ключа"""
-    composite_key = f"{key}:{sort_key}" if sort_key else key
+    """EXISTS — перевірка наявності ключа: 200 або 404 без тіла"""
+    composite_key = make_composite_key(key, sort_key)
     shard_name, shard_url = get_shard_for_key(composite_key)
-    async with httpx.AsyncClient() as client:
-        resp = await client.get(f"{shard_url}/exists/{table}/{key}", params={"sort_key": sort_key})
-    return {"target_shard": shard_name, "response": resp.json()}
+    resp = await shard_request(
+        "HEAD", f"{shard_url}/exists/{table}/{key}", params={"sort_key": sort_key}, headers=key_header(composite_key)
+    )
+    return Response(status_code=resp.status_code, headers={"x-target-shard": shard_name})
 
 @app.put("/update")
-async def update_record(data: KeyValue):
+async def update_record(request: Request):
     """UPDATE — оновлює запис у відповідному shard"""
     # Використовуємо той самий ключ для маршрутизації
-    composite_key = f"{data.key}:{data.sort_key}" if data.sort_key else data.key
+    raw = await request.body()
+    table, composite_key = routing_key(raw)
     shard_name, shard_url = get_shard_for_key(composite_key)
-    
-    # Передаємо повні дані, включаючи composite_key
-    payload = data.dict()
-    payload["composite_key"] = composite_key # Додаємо ключ для зручності шарда
-    
-    async with httpx.AsyncClient() as client:
-        resp = await client.put(f"{shard_url}/update", json=payload)
+
+    # Передаємо сирі дані, composite_key — у заголовку для зручності шарда
+    resp = await shard_request("PUT", f"{shard_url}/update", content=raw, headers=forward_headers(composite_key))
     
     if resp.status_code != 200:
         raise HTTPException(status_code=resp.status_code, detail=resp.text)
-    return {"target_shard": shard_name, "response": resp.json()}
+    forget_flight(table, composite_key)
+    return Response(content=envelope(shard_name, resp), media_type="application/json")
 
 @app.delete("/delete/{table}/{key}")
 async def delete_record(table: str, key: str, sort_key: Optional[str] = None):
     """DELETE — видаляє ключ у відповідному shard"""
-    composite_key = f"{key}:{sort_key}" if sort_key else key
+    composite_key = make_composite_key(key, sort_key)
     shard_name, shard_url = get_shard_for_key(composite_key)
-    async with httpx.AsyncClient() as client:
-        resp = await client.delete(f"{shard_url}/delete/{table}/{key}", params={"sort_key": sort_key})
+    resp = await shard_request(
+        "DELETE", f"{shard_url}/delete/{table}/{key}", params={"sort_key": sort_key}, headers=key_header(composite_key)
+    )
     if resp.status_code not in (200, 204):
         raise HTTPException(status_code=resp.status_code, detail=resp.text)
-    return {"target_shard": shard_name, "response": resp.json()}
\ No newline at end of file
+    forget_flight(table, composite_key)
+    return Response(content=envelope(shard_name, resp), media_type="application/json")
+
+# --- Batch маршрутизація ---
+async def fan_out(path: str, groups: Dict[str, List[KeyValue]]):
+    """Паралельно надсилає групи записів на відповідні shards"""
+    names = list(groups)
+    tasks = [
+        shard_request(
+            "POST", f"{SHARDS[name]}/{path}", content=msgspec.json.encode(groups[name]), headers=JSON_HEADERS
+        )
+        for name in names
+    ]
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    responses = {}
+    for name, result in zip(names, results):
+        if isinstance(result, Exception):
+            responses[name] = {"error": str(result)}
+        elif result.status_code != 200:
+            responses[name] = {"error": result.text, "status_code": result.status_code}
+        else:
+            responses[name] = orjson.loads(result.content)
+    return {"responses": responses}
+
+
+def group_by_shard(items: List[KeyValue]) -> Dict[str, List[KeyValue]]:
+    """Групує записи по shard і проставляє кожному composite_key"""
+    groups: Dict[str, List[KeyValue]] = defaultdict(list)
+    keys = [make_composite_key(item.key, item.sort_key) for item in items]
+    for item, composite_key, shard_name in zip(items, keys, shards_for_keys(keys)):
+        item.composite_key = composite_key
+        groups[shard_name].append(item)
+    return groups
+
+
+@app.post("/batch_create")
+async def batch_create(request: Request):
+    """BATCH CREATE — групує записи по shard і створює їх паралельно"""
+    items = decode_body(BATCH_DECODER, await request.body())
+    result = await fan_out("batch_create", group_by_shard(items))
+    for item in items:
+        forget_flight(item.table, item.composite_key)
+    return result
+
+
+@app.post("/batch_read")
+async def batch_read(request: Request):
+    """BATCH READ — групує ключі по shard і читає їх паралельно"""
+    items = decode_body(BATCH_DECODER, await request.body())
+    for item in items:
+        item.value = None  # для читання значення не потрібне — omit_defaults не передасть його
+    return await fan_out("batch_read", group_by_shard(items))
+
+
+@app.get("/range/{table}/{key}")
+async def range_records(table: str, key: str, lo: Optional[str] = None, hi: Optional[str] = None):
+    """RANGE — записи партиції з sort_key у межах [lo, hi] з усіх shards"""
+    # sort_key входить у ключ маршрутизації, тож одна партиція розкидана по всіх shards
+    if not SHARDS:
+        raise HTTPException(status_code=500, detail="No shards available")
+    params = {name: value for name, value in (("lo", lo), ("hi", hi)) if value is not None}
+    names = list(SHARDS)
+    tasks = [shard_request("GET", f"{SHARDS[name]}/range/{table}/{key}", params=params) for name in names]
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    parts = []
+    for name, result in zip(names, results):
+        if isinstance(result, Exception):
+            raise HTTPException(status_code=502, detail=f"Shard {name} unavailable: {result}")
+        if result.status_code == 404:
+            continue  # на цьому shard таблиця ще не має записів
+        if result.status_code != 200:
+            raise HTTPException(status_code=result.status_code, detail=result.text)
+        parts.append(orjson.loads(result.content)["records"])
+    # Кожен shard повертає відсортований список, тож достатньо злиття
+    records = list(heapq.merge(*parts, key=lambda record: record["sort_key"]))
+    return {"key": key, "records": records}
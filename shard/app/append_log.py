@@ -0,0 +1,136 @@
+import asyncio
+import os
+from typing import Iterable, Iterator, List, Optional, Tuple
+import orjson
+
+
+class AppendLog:
+    """Журнал операцій shard: append-only файл плюс періодичний знімок.
+
+    Усі операції — абсолютні записи (put/delete), тож повторне застосування
+    вже врахованих у знімку операцій не змінює результат відновлення.
+
+    Записи групуються (group commit): операції, що надійшли протягом вікна
+    window секунд, записуються одним write і підтверджуються одним fsync.
+    """
+
+    def __init__(self, directory: str, name: str, window: float = 0.002):
+        self.directory = directory
+        self.log_path = os.path.join(directory, f"{name}.log")
+        self.old_log_path = self.log_path + ".old"
+        self.snapshot_path = os.path.join(directory, f"{name}.snap")
+        self.window = window
+        self.fd: Optional[int] = None
+        self.pending: List[Tuple[bytes, asyncio.Future]] = []
+        self.has_pending = asyncio.Event()
+        self.lock = asyncio.Lock()  # flush і ротація не перетинаються
+        self.flusher: Optional[asyncio.Task] = None
+
+    def replay(self) -> Iterator[dict]:
+        """Операції для відновлення: знімок, журнал до ротації, поточний журнал"""
+        for path in (self.snapshot_path, self.old_log_path, self.log_path):
+            if not os.path.exists(path):
+                continue
+            valid_length = 0
+            with open(path, "rb") as f:
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        break  # недописаний останній рядок після аварійної зупинки
+                    try:
+                        op = orjson.loads(line)
+                    except orjson.JSONDecodeError:
+                        break
+                    valid_length += len(line)
+                    yield op
+            if path == self.log_path and valid_length < os.path.getsize(path):
+                # Обрізаємо недописаний хвіст: інакше новий запис приклеїться до нього
+                # і при наступному відновленні загубиться разом з усім, що після нього
+                os.truncate(path, valid_length)
+
+    def open(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self._open_fd()
+        self.flusher = asyncio.create_task(self._flush_loop())
+
+    async def close(self):
+        """Дописує все, що чекає в черзі, і закриває журнал"""
+        if self.flusher is not None:
+            flusher, self.flusher = self.flusher, None
+            # Під lock flusher не перебуває всередині write/fsync — скасування не обірве запис
+            async with self.lock:
+                flusher.cancel()
+            await asyncio.gather(flusher, return_exceptions=True)
+        await self.flush()
+        self._close_fd()
+
+    async def append(self, *ops: dict):
+        """Ставить операції в чергу і чекає, доки їх group commit потрапить на диск"""
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((b"".join(orjson.dumps(op) + b"\n" for op in ops), future))
+        self.has_pending.set()
+        await future
+
+    async def flush(self):
+        """Один write + один fsync для всіх накопичених операцій"""
+        async with self.lock:
+            batch, self.pending = self.pending, []
+            self.has_pending.clear()
+            if not batch:
+                return
+            try:
+                await asyncio.to_thread(self._write_sync, b"".join(data for data, _ in batch))
+            except Exception as exc:  # будь-яка помилка лише відхиляє цю пачку, flusher живе далі
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(exc)
+                return
+            for _, future in batch:
+                if not future.done():
+                    future.set_result(None)
+
+    async def rotate(self):
+        """Починає новий журнал; старий потрібен, доки не записано знімок"""
+        async with self.lock:
+            if os.path.exists(self.old_log_path):
+                return  # попередній знімок не дописано — продовжуємо поточний журнал
+            try:
+                self._close_fd()
+                os.replace(self.log_path, self.old_log_path)
+            finally:
+                # Навіть якщо ротація не вдалася, журнал лишається відкритим для наступних записів
+                self._open_fd()
+
+    async def _flush_loop(self):
+        while True:
+            await self.has_pending.wait()
+            await asyncio.sleep(self.window)  # збираємо записи, що надійдуть протягом вікна
+            await self.flush()
+
+    def _write_sync(self, data: bytes):
+        if self.fd is None:
+            self._open_fd()  # попереднє відкриття не вдалося — пробуємо знову
+        os.write(self.fd, data)
+        os.fsync(self.fd)
+
+    def _open_fd(self):
+        self.fd = os.open(self.log_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+
+    def _close_fd(self):
+        if self.fd is not None:
+            fd, self.fd = self.fd, None
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def write_snapshot(self, ops: Iterable[dict]):
+        """Записує знімок атомарно (tmp + fsync + rename) і прибирає старий журнал"""
+        tmp_path = self.snapshot_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            for op in ops:
+                f.write(orjson.dumps(op) + b"\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.snapshot_path)
+        if os.path.exists(self.old_log_path):
+            os.remove(self.old_log_path)
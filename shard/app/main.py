@@ -1,89 +1,327 @@
-from fastapi import FastAPI, HTTPException, Query
-from pydantic import BaseModel
-from typing import Dict, Any, Optional
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Query, Request, Response
+from fastapi.responses import JSONResponse
+from typing import Dict, Any, List, Optional, Set, Tuple
+from urllib.parse import unquote
 import os
 import httpx
+import msgspec
+import orjson
+from sortedcontainers import SortedDict
+from append_log import AppendLog
 
-app = FastAPI(title="Shard Node with Compound Key Support")
+logger = logging.getLogger(__name__)
 
 # --- Локальне сховище ---
-STORAGE: Dict[str, Dict[str, Any]] = {}
+STORAGE: Dict[Tuple[str, str], Any] = {}  # (table, composite_key) -> value
+TABLES: Set[str] = set()
+# (table, partition_key) -> SortedDict[sort_key, composite_key] для range-запитів по sort_key
+PARTITIONS: Dict[Tuple[str, str], SortedDict] = {}
+# (table, composite_key) -> (partition_key, sort_key): де запис лежить в індексі партицій
+SORT_KEYS: Dict[Tuple[str, str], Tuple[str, str]] = {}
 
 # --- Змінні середовища ---
 COORDINATOR_URL = os.getenv("COORDINATOR_URL")
 SHARD_NAME = os.getenv("SHARD_NAME")
+DATA_DIR = os.getenv("DATA_DIR")  # якщо не задано — shard працює лише в пам'яті
+COMPACT_INTERVAL = float(os.getenv("COMPACT_INTERVAL", "60"))
+GROUP_COMMIT_WINDOW = float(os.getenv("GROUP_COMMIT_WINDOW", "0.002"))  # секунди
 
+# Журнал операцій; відкривається в lifespan, якщо задано DATA_DIR
+LOG: Optional[AppendLog] = None
 
-class KeyValue(BaseModel):
+
+class FastJSONResponse(JSONResponse):
+    """JSON-відповідь, серіалізована orjson (ORJSONResponse у FastAPI застарів)"""
+
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY)
+
+
+def composite_key_for(request: Request, key: str, sort_key: Optional[str]) -> str:
+    """Складений ключ визначає координатор (x-composite-key); локально — лише для прямих викликів"""
+    header = request.headers.get("x-composite-key")
+    if header:
+        return unquote(header)
+    return f"{key}:{sort_key}" if sort_key else key
+
+
+# Схеми внутрішнього hop координатор -> shard: msgspec замість Pydantic
+class KeyValue(msgspec.Struct):
     table: str
     key: str
-    sort_key: Optional[str] = None
     value: dict
+    sort_key: Optional[str] = None
+    composite_key: Optional[str] = None
+
+
+class KeyRef(msgspec.Struct):
+    table: str
+    key: str
+    sort_key: Optional[str] = None
+    composite_key: Optional[str] = None
 
 
-@app.on_event("startup")
-async def register_with_coordinator():
+RECORD_DECODER = msgspec.json.Decoder(KeyValue)
+RECORDS_DECODER = msgspec.json.Decoder(List[KeyValue])
+REFS_DECODER = msgspec.json.Decoder(List[KeyRef])
+
+
+def load_body(decoder: msgspec.json.Decoder, raw: bytes):
+    """Декодує і валідує тіло запиту за схемою decoder; помилки формату — 422"""
+    try:
+        return decoder.decode(raw)
+    except msgspec.DecodeError as exc:
+        raise HTTPException(status_code=422, detail=str(exc))
+
+
+async def register_with_coordinator(client: httpx.AsyncClient):
     """Реєструє shard при запуску"""
-    async with httpx.AsyncClient() as client:
-        await client.post(
-            f"{COORDINATOR_URL}/register_shard",
-            json={"name": SHARD_NAME, "url": f"http://{SHARD_NAME}:8000"},
-        )
+    await client.post(
+        f"{COORDINATOR_URL}/register_shard",
+        json={"name": SHARD_NAME, "url": f"http://{SHARD_NAME}:8000"},
+    )
+
+
+def apply_op(op: dict):
+    """Застосовує операцію з журналу або знімка до сховища"""
+    kind, table = op["op"], op["t"]
+    TABLES.add(table)
+    if kind == "p":
+        STORAGE[(table, op["k"])] = op["v"]
+        index_sort_key(table, op.get("pk"), op.get("sk"), op["k"])
+    elif kind == "d":
+        STORAGE.pop((table, op["k"]), None)
+        unindex_sort_key(table, op["k"])
+    elif kind == "i":
+        index_sort_key(table, op["pk"], op["sk"], op["k"])
+
+
+async def log_op(*ops: dict):
+    """Дописує операції в журнал і чекає fsync, якщо persistence увімкнено"""
+    # Обробники змінюють сховище лише після успішного log_op, тож відхилений журналом запис
+    # не видно читанням і не потрапить у знімок. Future group commit завершуються в порядку
+    # запису, тому зміни в пам'яті застосовуються в тому ж порядку, що й у журналі
+    if LOG is not None:
+        await LOG.append(*ops)
+
+
+def snapshot_ops(tables, items, index):
+    """Операції знімка з копії стану: таблиці, записи, індекс партицій"""
+    for table in tables:
+        yield {"op": "t", "t": table}
+    for (table, composite_key), value in items:
+        yield {"op": "p", "t": table, "k": composite_key, "v": value}
+    for (table, key), entries in index:
+        for sort_key, composite_key in entries:
+            yield {"op": "i", "t": table, "pk": key, "sk": sort_key, "k": composite_key}
+
+
+async def compact_periodically(log: AppendLog):
+    """Раз на COMPACT_INTERVAL записує знімок сховища і відкидає старий журнал"""
+    while True:
+        await asyncio.sleep(COMPACT_INTERVAL)
+        # Операції, застосовані під час ротації, потраплять і в знімок, і в новий журнал —
+        # повторне застосування при відновленні нічого не змінює
+        try:
+            await log.rotate()
+            tables, items = list(TABLES), list(STORAGE.items())
+            index = [(partition_key, list(entries.items())) for partition_key, entries in PARTITIONS.items()]
+            # Серіалізація і запис — у потоці, щоб не блокувати event loop
+            await asyncio.to_thread(log.write_snapshot, snapshot_ops(tables, items, index))
+        except Exception:
+            # Помилка компактизації не зупиняє наступні спроби; журнали лишаються для відновлення
+            logger.exception("Compaction failed; keeping the logs for recovery")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Старт shard: відновлення з журналу, компактизація, спільний HTTP-клієнт; при зупинці — дописати журнал"""
+    global LOG
+    compaction = None
+    if DATA_DIR:
+        LOG = AppendLog(DATA_DIR, SHARD_NAME, window=GROUP_COMMIT_WINDOW)
+        for op in LOG.replay():
+            apply_op(op)
+        LOG.open()
+        compaction = asyncio.create_task(compact_periodically(LOG))
+    app.state.http = httpx.AsyncClient(timeout=httpx.Timeout(5.0))
+    try:
+        await register_with_coordinator(app.state.http)
+        yield
+    finally:
+        await app.state.http.aclose()
+        if compaction is not None:
+            compaction.cancel()
+            await LOG.close()
+
+
+app = FastAPI(
+    title="Shard Node with Compound Key Support",
+    lifespan=lifespan,
+    default_response_class=FastJSONResponse,
+)
+
+
+# Статичні відповіді — серіалізуються один раз
+HEALTH_BODY = orjson.dumps({"ok": True})
+TABLE_NOT_FOUND_BODY = orjson.dumps({"detail": "Table not found"})
+KEY_NOT_FOUND_BODY = orjson.dumps({"detail": "Key not found"})
+
+
+def not_found(body: bytes) -> Response:
+    """Швидка 404 без HTTPException: промах не проходить через обробник винятків"""
+    return Response(content=body, status_code=404, media_type="application/json")
+
+
+def index_sort_key(table: str, key: str, sort_key: Optional[str], composite_key: str):
+    """Індексує запис за (key, sort_key); попереднє місце цього composite_key в індексі прибирається"""
+    unindex_sort_key(table, composite_key)
+    if sort_key:
+        partition = PARTITIONS.get((table, key))
+        if partition is None:
+            partition = PARTITIONS[(table, key)] = SortedDict()
+        partition[sort_key] = composite_key
+        SORT_KEYS[(table, composite_key)] = (key, sort_key)
+
+
+def unindex_sort_key(table: str, composite_key: str):
+    """Прибирає запис з індексу партиції за тим місцем, куди його було проіндексовано"""
+    location = SORT_KEYS.pop((table, composite_key), None)
+    if location is None:
+        return
+    key, sort_key = location
+    partition = PARTITIONS.get((table, key))
+    if partition is not None and partition.get(sort_key) == composite_key:
+        del partition[sort_key]
+        if not partition:
+            del PARTITIONS[(table, key)]
+
+
+@app.get("/health")
+async def health():
+    """HEALTH — перевірка доступності; використовується координатором для прогріву з'єднання"""
+    return Response(content=HEALTH_BODY, media_type="application/json")
 
 
 @app.post("/create")
-def create(data: KeyValue):
+async def create(request: Request):
     """CREATE запис у локальному shard"""
-    if data.table not in STORAGE:
-        STORAGE[data.table] = {}
-    composite_key = f"{data.key}:{data.sort_key}" if data.sort_key else data.key
-    STORAGE[data.table][composite_key] = data.value
-    return {"message": "Created", "table": data.table, "key": composite_key}
+    data = load_body(RECORD_DECODER, await request.body())
+    table, key, sort_key = data.table, data.key, data.sort_key
+    composite_key = composite_key_for(request, key, sort_key)
+    op = {"op": "p", "t": table, "k": composite_key, "pk": key, "sk": sort_key, "v": data.value}
+    await log_op(op)
+    apply_op(op)
+    return {"message": "Created", "table": table, "key": composite_key}
 
 
 @app.get("/read/{table}/{key}")
-def read(table: str, key: str, sort_key: Optional[str] = Query(None)):
+async def read(request: Request, table: str, key: str, sort_key: Optional[str] = Query(None)):
     """READ — читання запису"""
-    if table not in STORAGE:
-        raise HTTPException(status_code=404, detail="Table not found")
-    composite_key = f"{key}:{sort_key}" if sort_key else key
-    if composite_key not in STORAGE[table]:
-        raise HTTPException(status_code=404, detail="Key not found")
-    return {"key": composite_key, "value": STORAGE[table][composite_key]}
+    if table not in TABLES:
+        return not_found(TABLE_NOT_FOUND_BODY)
+    composite_key = composite_key_for(request, key, sort_key)
+    value = STORAGE.get((table, composite_key))
+    if value is None:
+        return not_found(KEY_NOT_FOUND_BODY)
+    # Значення береться прямо з пам'яті — без повторної валідації відповіді
+    return FastJSONResponse({"key": composite_key, "value": value})
 
 
-@app.get("/exists/{table}/{key}")
-def exists(table: str, key: str, sort_key: Optional[str] = Query(None)):
-    """EXISTS — перевіряє, чи є запис"""
-    if table not in STORAGE:
-        return {"exists": False}
-    composite_key = f"{key}:{sort_key}" if sort_key else key
-    return {"exists": composite_key in STORAGE[table]}
+@app.api_route("/exists/{table}/{key}", methods=["GET", "HEAD"])
+async def exists(request: Request, table: str, key: str, sort_key: Optional[str] = Query(None)):
+    """EXISTS — 200, якщо запис є, інакше 404; тіла відповіді немає"""
+    composite_key = composite_key_for(request, key, sort_key)
+    return Response(status_code=200 if (table, composite_key) in STORAGE else 404)
 
 @app.put("/update")
-def update(data: KeyValue):
+async def update(request: Request):
     """UPDATE — оновлює запис у локальному сховищі"""
-    if data.table not in STORAGE:
+    data = load_body(RECORD_DECODER, await request.body())
+    table = data.table
+    if table not in TABLES:
         raise HTTPException(status_code=404, detail="Table not found")
-        
-    # Використовуємо ключ, який передав координатор
-    # (або обчислюємо його тут, якщо не передавати payload["composite_key"])
-    composite_key = f"{data.key}:{data.sort_key}" if data.sort_key else data.key
 
-    if composite_key not in STORAGE[data.table]:
+    # Використовуємо ключ, який передав координатор у x-composite-key
+    # (або обчислюємо його тут, якщо запит прийшов напряму)
+    key, sort_key = data.key, data.sort_key
+    composite_key = composite_key_for(request, key, sort_key)
+
+    if (table, composite_key) not in STORAGE:
         raise HTTPException(status_code=404, detail="Key not found for update")
 
-    # Оновлюємо значення
-    STORAGE[data.table][composite_key] = data.value
-    return {"message": "Updated", "table": data.table, "key": composite_key, "new_value": data.value}
+    # Оновлюємо значення, щойно журнал підтвердив запис
+    value = data.value
+    op = {"op": "p", "t": table, "k": composite_key, "pk": key, "sk": sort_key, "v": value}
+    await log_op(op)
+    apply_op(op)
+    return {"message": "Updated", "table": table, "key": composite_key, "new_value": value}
 
 @app.delete("/delete/{table}/{key}")
-def delete(table: str, key: str, sort_key: Optional[str] = Query(None)):
+async def delete(request: Request, table: str, key: str, sort_key: Optional[str] = Query(None)):
     """DELETE — видаляє запис"""
-    if table not in STORAGE:
+    if table not in TABLES:
         raise HTTPException(status_code=404, detail="Table not found")
-    composite_key = f"{key}:{sort_key}" if sort_key else key
-    if composite_key not in STORAGE[table]:
+    composite_key = composite_key_for(request, key, sort_key)
+    if (table, composite_key) not in STORAGE:
         raise HTTPException(status_code=404, detail="Key not found")
-    del STORAGE[table][composite_key]
-    return {"message": "Deleted", "key": composite_key}
\ No newline at end of file
+    op = {"op": "d", "t": table, "k": composite_key, "pk": key, "sk": sort_key}
+    await log_op(op)
+    # apply_op чистить індекс за збереженим місцем: sort_key у запиті може бути не заданий
+    apply_op(op)
+    return {"message": "Deleted", "key": composite_key}
+
+
+@app.post("/batch_create")
+async def batch_create(request: Request):
+    """BATCH CREATE — створює пачку записів одним оновленням сховища"""
+    items = load_body(RECORDS_DECODER, await request.body())
+    batch: Dict[Tuple[str, str], Any] = {}
+    ops = []
+    for data in items:
+        table, key, sort_key = data.table, data.key, data.sort_key
+        composite_key = data.composite_key or (f"{key}:{sort_key}" if sort_key else key)
+        value = data.value
+        batch[(table, composite_key)] = value
+        ops.append({"op": "p", "t": table, "k": composite_key, "pk": key, "sk": sort_key, "v": value})
+    await log_op(*ops)
+    # Сховище та індекс змінюються лише після того, як журнал підтвердив пачку
+    TABLES.update(op["t"] for op in ops)
+    STORAGE.update(batch)
+    for op in ops:
+        index_sort_key(op["t"], op["pk"], op["sk"], op["k"])
+    return {"message": "Created", "count": len(items)}
+
+
+@app.post("/batch_read")
+async def batch_read(request: Request):
+    """BATCH READ — читає пачку записів; відсутні ключі повертаються окремо"""
+    records = []
+    missing = []
+    for ref in load_body(REFS_DECODER, await request.body()):
+        table, key, sort_key = ref.table, ref.key, ref.sort_key
+        composite_key = ref.composite_key or (f"{key}:{sort_key}" if sort_key else key)
+        value = STORAGE.get((table, composite_key))
+        if value is None:
+            missing.append({"table": table, "key": composite_key})
+        else:
+            records.append({"table": table, "key": composite_key, "value": value})
+    return FastJSONResponse({"records": records, "missing": missing})
+
+
+@app.get("/range/{table}/{key}")
+async def range_read(table: str, key: str, lo: Optional[str] = Query(None), hi: Optional[str] = Query(None)):
+    """RANGE — записи партиції з sort_key у межах [lo, hi], відсортовані за sort_key"""
+    if table not in TABLES:
+        raise HTTPException(status_code=404, detail="Table not found")
+    partition = PARTITIONS.get((table, key))
+    records = []
+    if partition is not None:
+        for sort_key in partition.irange(lo, hi):
+            value = STORAGE.get((table, partition[sort_key]))
+            if value is not None:
+                records.append({"sort_key": sort_key, "value": value})
+    return FastJSONResponse({"key": key, "records": records})